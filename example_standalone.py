@@ -5,7 +5,6 @@ from sigmund_qtwidget.diff_dialog import DiffDialog
 from pyqt_code_editor.code_editors import create_editor
 from pyqt_code_editor import watchdog
 import logging
-import textwrap
 logging.basicConfig(level=logging.INFO, force=True)
 logger = logging.getLogger(__name__)
 
@@ -15,37 +14,63 @@ class EditorWorkspace:
     def __init__(self, editor):
         self._editor = editor
         self._indentation = ''
+        # Serializing the document is expensive for large buffers, so the
+        # current text is cached until the document or selection changes.
+        self._cached_text = None
+        self._cached_stripped = None
+        self._editor.document().contentsChanged.connect(self._invalidate_cache)
+        self._editor.selectionChanged.connect(self._invalidate_cache)
         
     def _get_indentation(self, content):
-        dedented = textwrap.dedent(content)
-        lines = content.splitlines()
-        dedented_lines = dedented.splitlines()
-    
-        for original_line, dedented_line in zip(lines, dedented_lines):
+        # Only the first non-empty line is needed to determine the indentation,
+        # so we scan for it rather than splitting and dedenting the full
+        # content.
+        idx = 0
+        n = len(content)
+        while idx < n:
+            nl = content.find('\n', idx)
+            if nl == -1:
+                nl = n
+            line = content[idx:nl]
             # Skip empty lines
-            if original_line.strip():
-                # Count leading whitespace
-                orig_leading = len(original_line) - len(original_line.lstrip(' \t'))
-                ded_leading = len(dedented_line) - len(dedented_line.lstrip(' \t'))
-                # The difference should be the indentation sequence
-                indentation_length = orig_leading - ded_leading
-                if indentation_length > 0:
-                    return original_line[:indentation_length]
-                return ""
+            if line.strip():
+                # The leading whitespace is the indentation sequence
+                return line[:len(line) - len(line.lstrip(' \t'))]
+            idx = nl + 1
         # If no non-empty lines, return no indentation
         return ""
         
     def prepare(self, content):
-        if content is None:
+        if not content or not self._indentation:
             return content
-        return textwrap.indent(content, self._indentation)             
+        # str.replace() is much faster than textwrap.indent(), which processes
+        # the content line by line. Unlike textwrap.indent(), this also indents
+        # empty lines, except for the empty line after a trailing newline.
+        indentation = self._indentation
+        indented = indentation + content.replace('\n', '\n' + indentation)
+        if content.endswith('\n'):
+            indented = indented[:-len(indentation)]
+        return indented
+
+    def _invalidate_cache(self):
+        self._cached_text = None
+        self._cached_stripped = None
+
+    def _current_text(self):
+        """Returns a (text, has_selection) tuple for the selected text, or for
+        the full editor content if there is no selection.
+        """
+        if self._cached_text is None:
+            text_cursor = self._editor.textCursor()
+            if text_cursor.hasSelection():
+                self._cached_text = text_cursor.selectedText(), True
+            else:
+                self._cached_text = self._editor.toPlainText(), False
+        return self._cached_text
 
     @property
     def content(self):
-        text_cursor = self._editor.textCursor()
-        if text_cursor.hasSelection():
-            return text_cursor.selectedText()
-        return self._editor.toPlainText()
+        return self._current_text()[0]
 
     @property        
     def language(self):
@@ -53,16 +78,14 @@ class EditorWorkspace:
         
     def _normalize_line_breaks(self, text):
         """Convert paragraph separators (U+2029) to standard newlines."""
-        if text:
+        if text and u'\u2029' in text:
             return text.replace(u'\u2029', '\n')
         return text        
         
     def get(self):
-        text_cursor = self._editor.textCursor()
-        if text_cursor.hasSelection():
-            content = self._normalize_line_breaks(text_cursor.selectedText())
-        else:
-            content = self._editor.toPlainText()
+        content, has_selection = self._current_text()
+        if has_selection:
+            content = self._normalize_line_breaks(content)
         self._indentation = self._get_indentation(content)
         logger.info(f'content was indented by "{self._indentation}"')        
         return content, self._editor.code_editor_language
@@ -76,15 +99,15 @@ class EditorWorkspace:
             self._editor.setPlainText(content)
 
     def has_changed(self, content, language):
-        text_cursor = self._editor.textCursor()
-        if text_cursor.hasSelection():
-            editor_content = text_cursor.selectedText()
-        else:
-            editor_content = self._editor.toPlainText()
-
-        if content in (editor_content, self.strip_content(editor_content)):
+        editor_content = self._current_text()[0]
+        # The content is unchanged if it matches either the raw or the
+        # stripped editor content. The stripped content is cached until the
+        # document or selection changes.
+        if content == editor_content:
             return False
-        return True
+        if self._cached_stripped is None:
+            self._cached_stripped = self.strip_content(editor_content)
+        return content != self._cached_stripped
     
     def strip_content(self, content):
         if content is None:
@@ -13,6 +13,7 @@ try:
 except ImportError:
     settings = None
 _ = translation_context('sigmund', category='extension')
+ICON_PATH = str(Path(__file__).parent / 'sigmund.png')
 
 
 class Sigmund(BaseExtension):
@@ -78,9 +79,38 @@ Ask Sigmund to fix this
     def event_rename_item(self, from_name, to_name):
         if not self._sigmund_widget:
             return
+        self._invalidate_experiment_struct()
         if self._sigmund_widget._current_item_name == from_name:
             self._sigmund_widget._current_item_name = to_name
 
+    def event_new_item(self, name, _type):
+        self._invalidate_experiment_struct()
+
+    def event_delete_item(self, name):
+        self._invalidate_experiment_struct()
+
+    def event_change_item(self, name):
+        self._invalidate_experiment_struct()
+
+    def event_linked_copy(self, name):
+        self._invalidate_experiment_struct()
+
+    def event_move_item(self, name):
+        self._invalidate_experiment_struct()
+
+    def event_regenerate(self):
+        self._invalidate_experiment_struct()
+
+    def event_open_experiment(self, path):
+        self._invalidate_experiment_struct()
+
+    def _invalidate_experiment_struct(self):
+        """The experiment structure is cached by the Sigmund widget, and needs
+        to be rebuilt whenever items change.
+        """
+        if self._sigmund_widget:
+            self._sigmund_widget.invalidate_experiment_struct()
+
     def activate(self, *dummy):
         """
         Called when the extension is activated. Toggles the dock’s visibility
@@ -139,5 +169,5 @@ Ask Sigmund to fix this
 
     def icon(self):
         """Return the icon for the extension."""
-        return str(Path(__file__).parent / 'sigmund.png')
+        return ICON_PATH
     
\ No newline at end of file
@@ -1,7 +1,7 @@
 import json
 import re
-import textwrap
 import traceback
+from types import MappingProxyType
 from qtpy.QtWidgets import QMessageBox
 from .chat_widget import OpenSesameChatWidget
 from sigmund_qtwidget.sigmund_widget import SigmundWidget
@@ -18,6 +18,43 @@ MAX_UNIQUE_VALUES = 5
 N_MAX_RESUMES = 3
 ACTION_CANCELLED = 'I do not approve this action.'
 MISSING_TOOL_CALL = 'It looks like you are trying use a tool, but you did not actually call the tool function. Please try again. Remember to call the tool function!'
+# Searching case-insensitively avoids making a lowercase copy of the message
+SUGGESTING_ACTION_PATTERN = re.compile(r'\(suggesting opensesame action\)',
+                                       re.IGNORECASE)
+INLINE_SCRIPT_PATTERN = re.compile(
+    r"# START_PREPARE_PHASE\s*(.*?)\s*# START_RUN_PHASE\s*(.*)", re.DOTALL)
+INLINE_JAVASCRIPT_PATTERN = re.compile(
+    r"// START_PREPARE_PHASE\s*(.*?)\s*// START_RUN_PHASE\s*(.*)", re.DOTALL)
+INLINE_SCRIPT_TEMPLATE = '''# START_PREPARE_PHASE
+{prepare}
+# START_RUN_PHASE
+{run}'''
+INLINE_JAVASCRIPT_TEMPLATE = '''// START_PREPARE_PHASE
+{prepare}
+// START_RUN_PHASE
+{run}'''
+# The transient settings are the same for every widget. Each widget works on a
+# copy, because send_user_message() updates the document-search setting.
+TRANSIENT_SETTINGS = MappingProxyType({
+    # These are interactive tools that result in a command function being
+    # called.
+    'tool_opensesame_select_item': 'true',
+    'tool_opensesame_new_item': 'true',
+    'tool_opensesame_remove_item_from_parent': 'true',
+    'tool_opensesame_rename_item': 'true',
+    'tool_opensesame_add_existing_item_to_parent': 'true',
+    'tool_opensesame_update_item_script': 'true',
+    'tool_opensesame_update_loop_table': 'true',
+    'tool_opensesame_update_run_if_expression': 'true',
+    'tool_opensesame_set_global_var': 'true',
+    'tool_opensesame_get_general_script': 'true',
+    'tool_opensesame_update_general_script': 'true',
+    # These are non-interactive tools that are handled by the server.
+    'tool_opensesame_get_syntax_documentation': 'true',
+    # We don't use the workspace, so disable it
+    'tool_update_workspace_content': 'false',
+    'tool_save_workspace_as_note': 'false'
+})
 
 
 class OpenSesameSigmundWidget(SigmundWidget):
@@ -29,26 +66,10 @@ class OpenSesameSigmundWidget(SigmundWidget):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._current_item_name = None
-        self._transient_settings = {
-            # These are interactive tools that result in a command function being
-            # called.
-            'tool_opensesame_select_item': 'true',
-            'tool_opensesame_new_item': 'true',
-            'tool_opensesame_remove_item_from_parent': 'true',
-            'tool_opensesame_rename_item': 'true',
-            'tool_opensesame_add_existing_item_to_parent': 'true',
-            'tool_opensesame_update_item_script': 'true',
-            'tool_opensesame_update_loop_table': 'true',
-            'tool_opensesame_update_run_if_expression': 'true',
-            'tool_opensesame_set_global_var': 'true',
-            'tool_opensesame_get_general_script': 'true',
-            'tool_opensesame_update_general_script': 'true',
-            # These are non-interactive tools that are handled by the server.
-            'tool_opensesame_get_syntax_documentation': 'true',
-            # We don't use the workspace, so disable it
-            'tool_update_workspace_content': 'false',
-            'tool_save_workspace_as_note': 'false'
-        }
+        # The item tree is cached as a (start item name, struct) tuple, and
+        # invalidated by the extension when items change
+        self._item_struct_cache = None
+        self._transient_settings = dict(TRANSIENT_SETTINGS)
         
     @property
     def items(self):
@@ -89,77 +110,90 @@ class OpenSesameSigmundWidget(SigmundWidget):
         # requests the tool use in the reply based on previous messages. If this
         # happens, send a kind reminder.
         if not is_command and \
-                '(suggesting opensesame action)' in message_text.lower():
+                SUGGESTING_ACTION_PATTERN.search(message_text):
             self.send_user_message(MISSING_TOOL_CALL)
             return True  # To avoid the message from being processed further
         return is_command
             
     def run_command_select_item(self, item_name):
-        if item_name not in self.items:
+        items = self.items
+        if item_name not in items:
             return f'Item {item_name} does not exist.'        
         
         if not self._confirm_action(_('Select item {}').format(item_name)):
             return ACTION_CANCELLED
-        self.items[item_name].open_tab()
+        items[item_name].open_tab()
         return f'Item {item_name} is now selected.'
         
     def run_command_new_item(self, item_name, item_type, parent_item_name,
                              index=0):
-        if item_name in self.items:
+        items = self.items
+        if item_name in items:
             return f'Item {item_name} already exists, please choose a different name.'
-        if parent_item_name not in self.items:
+        if parent_item_name not in items:
             return f'Parent item {parent_item_name} does not exist.'
         if not self._confirm_action(_('Create new item {}').format(item_name)):
             return ACTION_CANCELLED
-        self.items.new(item_type, item_name)
-        self.items[parent_item_name].insert_child_item(item_name, index)
-        self.items[item_name].open_tab()
+        items.new(item_type, item_name)
+        items[parent_item_name].insert_child_item(item_name, index)
+        self.invalidate_experiment_struct()
+        items[item_name].open_tab()
         return f'Item {item_name} has been created and is now selected.'
         
     def run_command_add_existing_item_to_parent(self, item_name,
                                                 parent_item_name, index=0):
-        if item_name not in self.items:
+        items = self.items
+        if item_name not in items:
             return f'Item {item_name} does not exist.'
-        if parent_item_name not in self.items:
+        if parent_item_name not in items:
             return f'Parent item {parent_item_name} does not exist.'
         if not self._confirm_action(_('Create new item {}').format(item_name)):
             return ACTION_CANCELLED
-        self.items[parent_item_name].insert_child_item(item_name, index)
-        self.items[item_name].open_tab()
+        items[parent_item_name].insert_child_item(item_name, index)
+        self.invalidate_experiment_struct()
+        items[item_name].open_tab()
         return f'Item {item_name} has been added and is now selected.'
         
     def run_command_remove_item_from_parent(self, parent_item_name, index=0):
-        if parent_item_name not in self.items:
+        items = self.items
+        if parent_item_name not in items:
             return f'Parent item {parent_item_name} does not exist.'
         if not self._confirm_action(
                 _('Remove item from parent {}').format(parent_item_name)):
             return ACTION_CANCELLED
-        item_name = self.items[parent_item_name].direct_children()[index]
-        self.items[parent_item_name].remove_child_item(item_name, index)
-        self.items[parent_item_name].open_tab()
+        parent_item = items[parent_item_name]
+        item_name = parent_item.direct_children()[index]
+        parent_item.remove_child_item(item_name, index)
+        self.invalidate_experiment_struct()
+        parent_item.open_tab()
         return f'Item has been removed from {parent_item_name}.'
         
     def run_command_update_run_if_expression(self, parent_sequence_name, index=0,
                                              run_if=True):
-        if parent_sequence_name not in self.items:
+        items = self.items
+        if parent_sequence_name not in items:
             return f'Parent sequence item {parent_sequence_name} does not exist.'
         if not self._confirm_action(
                 _('Update run-if expression in {}').format(parent_sequence_name)):
             return ACTION_CANCELLED
-        self.items[parent_sequence_name].set_run_if(index, run_if)
-        self.items[parent_sequence_name].open_tab()
+        parent_sequence = items[parent_sequence_name]
+        parent_sequence.set_run_if(index, run_if)
+        self.invalidate_experiment_struct()
+        parent_sequence.open_tab()
         return f'Run-if expression has been updated in {parent_sequence_name}.'
         
     def run_command_rename_item(self, from_item_name, to_item_name):
-        if from_item_name not in self.items:
+        items = self.items
+        if from_item_name not in items:
             return f'Item {from_item_name} does not exist.'
-        if to_item_name in self.items:
+        if to_item_name in items:
             return f'Item {to_item_name} already exists, please choose a different name.'
         if not self._confirm_action(
                 _('Rename item {} to {}').format(from_item_name, to_item_name)):
             return ACTION_CANCELLED
-        self.items.rename(from_item_name, to_item_name)
-        self.items[to_item_name].open_tab()
+        items.rename(from_item_name, to_item_name)
+        self.invalidate_experiment_struct()
+        items[to_item_name].open_tab()
         return f'{from_item_name} has been renamed to {to_item_name}.'
         
     def run_command_update_item_script(self, item_name, script):        
@@ -184,15 +218,19 @@ class OpenSesameSigmundWidget(SigmundWidget):
 {traceback.format_exc()}
 ```
 '''
+        finally:
+            # Even a failed parse may have partly changed the item
+            self.invalidate_experiment_struct()
         return f'{item_name} has been updated.'
 
     def run_command_update_loop_table(self, item_name, columns):
         """Updates the loop table of a loop item based on a dictionary of
         columns, similar to a DataFrame.
         """
-        if item_name not in self.items:
+        items = self.items
+        if item_name not in items:
             return f'Item {item_name} does not exist.'
-        loop_item = self.items[item_name]
+        loop_item = items[item_name]
         if loop_item.item_type != 'loop':
             return f'Item {item_name} is not a loop item.'
         # Validate that all columns have the same length
@@ -215,7 +253,8 @@ class OpenSesameSigmundWidget(SigmundWidget):
         # Assign the new DataMatrix to the loop item and update the UI
         loop_item.dm = dm
         loop_item.update()
-        self.items[item_name].open_tab()
+        self.invalidate_experiment_struct()
+        loop_item.open_tab()
         return f'Loop table of {item_name} has been updated with {lengths[0]} cycles and {len(columns)} columns.'
 
     @staticmethod
@@ -253,11 +292,13 @@ class OpenSesameSigmundWidget(SigmundWidget):
         
     def run_command_update_general_script(self, script):
         err_msg = self.sigmund_extension.main_window.regenerate(script)
+        self.invalidate_experiment_struct()
         if err_msg is None:
             return 'The general script has been updated. Please ask the user the review the experiment.'
         return f'An error occurred while updating the general script:\n\n{err_msg}'
 
-    def _item_struct(self, item):
+    def _item_node(self, item):
+        """Builds the structure of a single item, without its children."""
         d = {'item_name': item.name, 'item_type': item.item_type}
         if item.item_type == 'loop':
             d['variables'] = {}
@@ -268,24 +309,50 @@ class OpenSesameSigmundWidget(SigmundWidget):
                         [_('(… {} more unique values not shown)').format(
                             len(unique_values) - MAX_UNIQUE_VALUES)]
                 d['variables'][varname] = unique_values
-        if item.direct_children():
-            d['children'] = [
-                self._item_struct(self.items[child])
-                for child in item.direct_children()
-            ]
         return d
 
+    def _item_struct(self, item):
+        """Builds the structure of an item and all of its descendants. This
+        walks the item tree with an explicit stack rather than recursively.
+        """
+        root = self._item_node(item)
+        stack = [(item, root)]
+        while stack:
+            item, d = stack.pop()
+            children = item.direct_children()
+            if not children:
+                continue
+            d['children'] = []
+            for child_name in children:
+                child = self.items[child_name]
+                child_d = self._item_node(child)
+                d['children'].append(child_d)
+                stack.append((child, child_d))
+        return root
+
+    def invalidate_experiment_struct(self):
+        """Should be called when items have changed, so that the item tree is
+        rebuilt for the next message.
+        """
+        self._item_struct_cache = None
+
     def _experiment_struct(self):
         """Recursively builds the experiment structure from items. Right now,
         item_name and item_type are included for all items. Children are
         included if available. Variables are only included for loop items. Files
         from the file pool are also included.
+
+        The item tree is cached until invalidate_experiment_struct() is called.
+        The file pool and global variables are cheap to retrieve, and are
+        always retrieved fresh.
         """
-        exp_struct = self._item_struct(
-            self.items[
-                self.sigmund_extension.experiment.var.start
-            ]
-        )
+        start = self.sigmund_extension.experiment.var.start
+        if self._item_struct_cache is None or \
+                self._item_struct_cache[0] != start:
+            self._item_struct_cache = (start,
+                                       self._item_struct(self.items[start]))
+        # Copy the cached dict, because we add keys to it
+        exp_struct = dict(self._item_struct_cache[1])
         pool_files = self.sigmund_extension.pool.files()
         if len(pool_files) > MAX_POOL_FILES:
             n_hidden = len(pool_files) - MAX_POOL_FILES
@@ -299,8 +366,14 @@ class OpenSesameSigmundWidget(SigmundWidget):
         return exp_struct
 
     def send_user_message(self, text, *args, **kwargs):
-        item_name = self.current_item_name
-        item_type = self.current_item_type
+        # The current item is looked up only once, because each lookup checks
+        # the item store
+        item = self.current_item
+        if item is None:
+            item_name = item_type = None
+        else:
+            item_name = item.name
+            item_type = item.item_type
         if item_name is None:
             current_item_hint = 'No item is currently selected.'
         else:
@@ -314,12 +387,16 @@ class OpenSesameSigmundWidget(SigmundWidget):
 - You do not need to select {item_name} again, because it is already selected.
 - To modify the script of {item_name}, call `opensesame_update_item_script`.
 - {scripting_hint}'''                
+        # The structure is serialized compactly, because whitespace only adds
+        # to the size of the prompt
+        exp_struct = json.dumps(self._experiment_struct(),
+                                separators=(',', ':'), ensure_ascii=False)
         system_prompt = f'''## OpenSesame context
 
 You're working on an OpenSesame experiment with the following structure:
 
 <experiment_structure>
-{json.dumps(self._experiment_struct(), indent=2)}
+{exp_struct}
 </experiment_structure>
 
 ## Current item
@@ -348,8 +425,8 @@ To update a loop table:
 '''
         self._transient_system_prompt = system_prompt
         self._foundation_document_topics = ['opensesame']
-        if self.current_item_type is not None:
-            self._foundation_document_topics += [self.current_item_type]
+        if item_type is not None:
+            self._foundation_document_topics += [item_type]
         self._transient_settings['collection_opensesame'] = \
             'true' if cfg.sigmund_search_docs else 'false'        
         super().send_user_message(text, *args, **kwargs)
@@ -385,16 +462,18 @@ To update a loop table:
             return ''
         # Normally, the script starts with a 'define' line and is indented by
         # a tab. We want to undo this, and present only unindented content.
-        script = item.to_string()
-        script = textwrap.dedent(script[script.find(u'\t'):])
+        # Because the indentation is always exactly one tab, we can simply
+        # remove it, which is much faster than textwrap.dedent(). Everything
+        # up to and including the first tab is the define line.
+        script = item.to_string().partition(u'\t')[2]
+        script = script.replace(u'\n\t', u'\n')
         return script.strip()
         
     def _parse_inline_script(self, content):
         item = self.current_item
         if item is None:
             return        
-        pattern = r"# START_PREPARE_PHASE\s*(.*?)\s*# START_RUN_PHASE\s*(.*)"
-        match = re.search(pattern, content, re.DOTALL)
+        match = INLINE_SCRIPT_PATTERN.search(content)
         if match:
             prepare = match.group(1).strip()
             run = match.group(2).strip()
@@ -410,17 +489,14 @@ To update a loop table:
         item = self.current_item
         if item is None:
             return ''
-        return f'''# START_PREPARE_PHASE
-{item.var._prepare}
-# START_RUN_PHASE
-{item.var._run}'''
+        return INLINE_SCRIPT_TEMPLATE.format(prepare=item.var._prepare,
+                                             run=item.var._run)
 
     def _parse_inline_javascript(self, content):
         item = self.current_item
         if item is None:
             return
-        pattern = r"// START_PREPARE_PHASE\s*(.*?)\s*// START_RUN_PHASE\s*(.*)"
-        match = re.search(pattern, content, re.DOTALL)
+        match = INLINE_JAVASCRIPT_PATTERN.search(content)
         if match:
             prepare = match.group(1).strip()
             run = match.group(2).strip()
@@ -436,7 +512,5 @@ To update a loop table:
         item = self.current_item
         if item is None:
             return ''
-        return f'''// START_PREPARE_PHASE
-{item.var._prepare}
-// START_RUN_PHASE
-{item.var._run}'''
+        return INLINE_JAVASCRIPT_TEMPLATE.format(prepare=item.var._prepare,
+                                                 run=item.var._run)
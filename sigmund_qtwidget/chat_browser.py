@@ -1,9 +1,51 @@
 import re
 import sys
-from qtpy.QtWidgets import QTextBrowser, QApplication
-from qtpy.QtGui import QFont
+from functools import lru_cache
+from qtpy.QtWidgets import QTextBrowser
+from qtpy.QtGui import QFont, QDesktopServices, QTextCursor
 from qtpy.QtCore import QTimer
 
+# User messages can be very long, for example when a script or a traceback is
+# pasted. Beyond this length, only the start of the message is shown, together
+# with a link to show the full message.
+MAX_MESSAGE_CHARS = 4000
+EXPAND_SCHEME = 'sigmund-expand'
+# Links with these schemes are opened outside of the chat
+EXTERNAL_SCHEMES = ('http', 'https', 'mailto')
+# The chat counts as scrolled to the bottom if the scrollbar is within this
+# many pixels from its maximum.
+SCROLL_TOLERANCE = 4
+# To keep the document small in long conversations, only the most recent
+# messages are shown. Once TRIM_MESSAGES messages beyond this limit have been
+# appended, the chat is re-rendered, so that this happens only occasionally.
+MAX_RENDERED_MESSAGES = 200
+TRIM_MESSAGES = 50
+TRIMMED_NOTICE = '<div class="message-info">Earlier messages are not shown</div>'
+# Patterns for the parts of AI messages that are not shown
+SIGNATURE_PATTERN = re.compile(
+    r'<div\s+class="thinking_block_signature">(.*?)</div>')
+CONTENT_PATTERN = re.compile(
+    r'<div\s+class="thinking_block_content">(.*?)</div>', re.DOTALL)
+INFO_PATTERN = re.compile(
+    r'<div\s+class="message-info"\s+markdown="1">(.*?)</div>', re.DOTALL)
+
+
+@lru_cache(maxsize=None)
+def _chat_font():
+    """Returns an emoji-supporting font for the current platform. The font is
+    created on first use, because this requires a QApplication, and is then
+    shared by all chat browsers.
+    """
+    font = QFont()
+    if sys.platform == "win32":
+        font.setFamily("Segoe UI, Segoe UI Emoji, Arial, sans-serif")
+    elif sys.platform == "darwin":
+        font.setFamily("SF Pro Display, Apple Color Emoji, Helvetica Neue, sans-serif")
+    else:
+        font.setFamily("Noto Sans, Noto Color Emoji, DejaVu Sans, sans-serif")
+    font.setPointSize(10)
+    return font
+
 
 class ChatBrowser(QTextBrowser):
     """
@@ -14,23 +56,36 @@ class ChatBrowser(QTextBrowser):
     def __init__(self, parent=None):
         super().__init__(parent)
         self._messages = []  # Store messages as a list of (msg_type, text) tuples
+        # The HTML of each message is created once, when it is appended
+        self._html = []
+        self._expanded = set()  # Indices of long messages that are shown in full
+        self._rendered_count = 0  # Number of messages that are in the document
+        self._first_rendered = 0  # Index of the first message in the document
+        # Rendering is deferred to the next event-loop iteration, so that
+        # multiple messages that are appended in quick succession result in
+        # only a single re-render and scroll.
+        self._pending_scroll = False
+        self._render_on_show = False  # Set if a render was skipped while hidden
+        self._scroll_cleanup = None  # Disconnects the last scroll_to_bottom()
+        self._render_timer = QTimer(self)
+        self._render_timer.setSingleShot(True)
+        self._render_timer.setInterval(0)
+        self._render_timer.timeout.connect(self._flush_messages)
         self._init_browser()
 
     def _init_browser(self):
         """Initialize the browser with proper settings and styling."""
-        self.setOpenExternalLinks(True)
+        # Links are handled manually, so that the links to show full messages
+        # can be intercepted, see _on_anchor_clicked().
+        self.setOpenLinks(False)
+        self.anchorClicked.connect(self._on_anchor_clicked)
         self.setReadOnly(True)
+        # The chat cannot be edited, so there's no need to keep an undo history
+        # of all inserted messages
+        self.document().setUndoRedoEnabled(False)
 
         # Set up emoji-supporting font
-        font = QFont()
-        if sys.platform == "win32":
-            font.setFamily("Segoe UI, Segoe UI Emoji, Arial, sans-serif")
-        elif sys.platform == "darwin":
-            font.setFamily("SF Pro Display, Apple Color Emoji, Helvetica Neue, sans-serif")
-        else:
-            font.setFamily("Noto Sans, Noto Color Emoji, DejaVu Sans, sans-serif")
-        font.setPointSize(10)
-        self.setFont(font)
+        self.setFont(_chat_font())
 
         # Set the stylesheet on the document. We only load the stylesheet module
         # here because the app needs to be initialized for darkmode detection.
@@ -49,27 +104,55 @@ class ChatBrowser(QTextBrowser):
                 .replace('"', '&quot;')
                 .replace("'", '&#39;'))
 
-    def _render_messages(self):
-        """Render all messages with the current stylesheet."""
-        html_parts = ['<html><head><meta charset="utf-8"></head><body>']
-
-        for msg_type, text in self._messages:
-            if len(html_parts) > 1:  # Not the first message
-                html_parts.append('<hr>')
+    def _message_html(self, index, msg_type, text):
+        """Returns the HTML for a single message."""
+        if msg_type == "user":
+            truncated = len(text) > MAX_MESSAGE_CHARS and \
+                index not in self._expanded
+            if truncated:
+                text = text[:MAX_MESSAGE_CHARS]
+            # Escape HTML for user messages, but add br tags instead of
+            # newlines, which are ignored by the text browser
+            escaped_text = self._escape_html(text).replace('\n', '<br>')
+            if truncated:
+                escaped_text += f'… <a href="{EXPAND_SCHEME}:{index}">Show full message</a>'
+            return f'<div class="user-message bubble">{escaped_text}</div>'
+        # AI messages can contain HTML
+        return f'<div class="ai-message bubble">{text}</div>'
 
-            if msg_type == "user":
-                # Escape HTML for user messages, but add br tags instead of
-                # newlines, which are ignored by the text browser
-                escaped_text = self._escape_html(text).replace('\n', '<br>')
-                html_parts.append(f'<div class="user-message bubble">{escaped_text}</div>')
-            else:
-                # AI messages can contain HTML
-                html_parts.append(f'<div class="ai-message bubble">{text}</div>')
-
-        html_parts.append('</body></html>')
+    def _render_messages(self):
+        """Render all messages with the current stylesheet. Only the most
+        recent MAX_RENDERED_MESSAGES messages are included.
+        """
+        first = max(0, len(self._messages) - MAX_RENDERED_MESSAGES)
+        fragments = self._html[first:]
+        if first:
+            fragments.insert(0, TRIMMED_NOTICE)
+        # Set the HTML content, with separators between messages
+        self.setHtml(
+            '<html><head><meta charset="utf-8"></head><body>'
+            + '<hr>'.join(fragments) + '</body></html>')
+        self._first_rendered = first
+        self._rendered_count = len(self._messages)
 
-        # Set the HTML content
-        self.setHtml(''.join(html_parts))
+    def _render_new_messages(self):
+        """Render only the messages that have been added since the last
+        render, by inserting them at the end of the document. This avoids
+        re-parsing and laying out the full chat for every new message.
+        """
+        html = ''.join(
+            f'<hr>{fragment}' if index > self._first_rendered else fragment
+            for index, fragment in enumerate(
+                self._html[self._rendered_count:],
+                start=self._rendered_count))
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        # All new messages are inserted in one edit block, so that the
+        # document emits its change signals and is laid out only once
+        cursor.beginEditBlock()
+        cursor.insertHtml(html)
+        cursor.endEditBlock()
+        self._rendered_count = len(self._messages)
 
     def append_message(self, msg_type, text, scroll=True):
         """
@@ -77,62 +160,156 @@ class ChatBrowser(QTextBrowser):
         e.g. for an AI reply.
         - msg_type: 'user' or 'ai' (for compatibility)
         """
-        if msg_type == 'ai':
-            text = self._clean_ai_message(text)
-        self._messages.append((msg_type, text))
-        self._render_messages()
-        if scroll:
-            self.scroll_to_bottom()
+        self.append_messages([(msg_type, text)], scroll)
+
+    def append_messages(self, messages, scroll=True):
+        """
+        Add multiple messages at once. The chat is only re-rendered once.
+        - messages: a list of (msg_type, text) tuples
+        """
+        for msg_type, text in messages:
+            if msg_type == 'ai':
+                text = self._clean_ai_message(text)
+            self._html.append(
+                self._message_html(len(self._messages), msg_type, text))
+            self._messages.append((msg_type, text))
+        self._schedule_render(scroll)
 
     def clear_messages(self):
         """Clear all messages from the chat."""
         self._messages.clear()
+        self._html.clear()
+        self._expanded.clear()
+        self._rendered_count = 0
+        self._first_rendered = 0
+        self._schedule_render(scroll=False)
+
+    def _on_anchor_clicked(self, url):
+        """Show the full message for expand links, scroll to in-document
+        links, such as footnotes, and open external links externally.
+        """
+        scheme = url.scheme()
+        if scheme in EXTERNAL_SCHEMES:
+            QDesktopServices.openUrl(url)
+            return
+        if scheme != EXPAND_SCHEME:
+            if url.isRelative() and not url.path() and url.hasFragment():
+                self.scrollToAnchor(url.fragment())
+            return
+        try:
+            index = int(url.path())
+        except ValueError:
+            return
+        if not 0 <= index < len(self._messages):
+            return
+        self._expanded.add(index)
+        self._html[index] = self._message_html(index, *self._messages[index])
+        # Re-render right away and restore the scroll position, so that the
+        # view doesn't jump away from the expanded message.
+        self._cancel_scroll()
+        scrollbar = self.verticalScrollBar()
+        value = scrollbar.value()
         self._render_messages()
+        scrollbar.setValue(value)
+
+    def _schedule_render(self, scroll):
+        """Schedule a re-render, and optionally a scroll to the bottom, for
+        the next event-loop iteration.
+        """
+        self._pending_scroll = self._pending_scroll or scroll
+        self._render_timer.start()
+
+    def _flush_messages(self):
+        """Render the messages and scroll if this was requested. We only
+        scroll to the bottom if the chat was already scrolled to the bottom,
+        so that users who have scrolled up to read earlier messages are not
+        pulled away. Otherwise, the scroll position is preserved.
+        """
+        # Rendering into a hidden browser, for example while the chat input is
+        # maximized, is wasted work. The render is then done when the browser
+        # is shown again.
+        if not self.isVisible():
+            self._render_on_show = True
+            return
+        self._render_on_show = False
+        scrollbar = self.verticalScrollBar()
+        value = scrollbar.value()
+        at_bottom = value >= scrollbar.maximum() - SCROLL_TOLERANCE
+        # If messages have only been added since the last render, they are
+        # appended to the document. Otherwise, or if the document has grown
+        # too long, the chat is fully re-rendered.
+        n_rendered = len(self._messages) - self._first_rendered
+        if not self._rendered_count or \
+                n_rendered > MAX_RENDERED_MESSAGES + TRIM_MESSAGES:
+            self._render_messages()
+        elif self._rendered_count < len(self._messages):
+            self._render_new_messages()
+        scroll = self._pending_scroll
+        self._pending_scroll = False
+        if scroll and at_bottom:
+            self.scroll_to_bottom()
+        else:
+            # A scroll from an earlier render may still be pending, which
+            # would pull the user back to the bottom
+            self._cancel_scroll()
+            scrollbar.setValue(value)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self._render_on_show:
+            self._flush_messages()
 
     def scroll_to_bottom(self):
         """Scroll to the bottom of the chat."""
+        scrollbar = self.verticalScrollBar()
+        active = [True]
+
         def _cleanup():
-            """Clean up any remaining connections to _do_scroll(). It's possible
-            everything is already disconnected, in which case we get a TypeError.
+            """Clean up the connection to _on_range_changed(). It's possible
+            that it is already disconnected, in which case we get a TypeError.
+            This can be called multiple times, but only disconnects once.
             """
+            if not active[0]:
+                return
+            active[0] = False
             try:
-                scrollbar.rangeChanged.disconnect()
+                scrollbar.rangeChanged.disconnect(_on_range_changed)
             except (TypeError, RuntimeError):
                 pass
-            
-        def _do_scroll(*_):
-            """We first need to process GUI events, and then scroll to the
-            bottom. Finally, we clean up to remove pending connections.
+
+        def _do_scroll():
+            if active[0]:
+                scrollbar.setValue(scrollbar.maximum())
+
+        def _on_range_changed(*_):
+            """Scroll to the bottom once the range has changed, and then clean
+            up, so that users who scroll up afterwards are not pulled back.
             """
-            QApplication.processEvents()
-            scrollbar.setValue(scrollbar.maximum())
+            _do_scroll()
             _cleanup()
-            
+
         # Possibly, the scrollbar has already settled, so we start by explictly
-        # scrolling. Next, we set up a deferred connection so that we scroll
-        # to the bottom when the range has changed (i.e. the content has 
-        # settled.)
-        QApplication.processEvents()
-        scrollbar = self.verticalScrollBar()
+        # scrolling. The document may still be laid out after this, so we also
+        # scroll when the range has changed (i.e. the content has settled) or
+        # at the next event-loop iteration. This avoids processing all pending
+        # events here, which could re-enter the chat while it is rendering.
+        self._cancel_scroll()
+        self._scroll_cleanup = _cleanup
         scrollbar.setValue(scrollbar.maximum())
-        _cleanup()
-        scrollbar.rangeChanged.connect(_do_scroll)
+        scrollbar.rangeChanged.connect(_on_range_changed)
+        QTimer.singleShot(0, _do_scroll)
         QTimer.singleShot(1000, _cleanup)
 
+    def _cancel_scroll(self):
+        """Cancel a pending scroll to the bottom, if any."""
+        if self._scroll_cleanup is not None:
+            self._scroll_cleanup()
+            self._scroll_cleanup = None
+
     def _clean_ai_message(self, content):
         """Removes Anthropic-style thinking blocks from the message."""
-        sig_pattern = r'<div\s+class="thinking_block_signature">(.*?)</div>'
-        cont_pattern = r'<div\s+class="thinking_block_content">(.*?)</div>'
-        info_pattern = r'<div\s+class="message-info"\s+markdown="1">(.*?)</div>'
-
-        # Single line pattern
-        sig_match = re.search(sig_pattern, content)
-        if sig_match:
-            content = re.sub(sig_pattern, '', content, count=1)    
-        # Multiline patterns
-        for pattern in (cont_pattern, info_pattern):
-            match = re.search(pattern, content, re.MULTILINE | re.DOTALL)
-            if match:
-                content = re.sub(pattern, '', content, count=1,
-                                 flags=re.MULTILINE | re.DOTALL)
+        # sub() leaves the content untouched if there is no match, so there
+        # is no need to search first
+        for pattern in (SIGNATURE_PATTERN, CONTENT_PATTERN, INFO_PATTERN):
+            content = pattern.sub('', content, count=1)
         return content.strip()
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from qtpy.QtWidgets import (
     QWidget,
     QVBoxLayout,
@@ -6,16 +7,25 @@ from qtpy.QtWidgets import (
     QPlainTextEdit,
     QSizePolicy,
 )
-# QtAwesome is optional, but it makes the UI look better.
-try:
-    import qtawesome as qta
-except ImportError:
-    pass
 from qtpy.QtCore import Signal, Qt
 from .chat_browser import ChatBrowser
 
 PLACEHOLDER_TEXT = "Enter your message"
 PLACEHOLDER_BUSY_TEXT = "Sigmund is thinking and typing …"
+MIN_MESSAGE_CHARS = 3
+
+
+@lru_cache(maxsize=None)
+def _icon(name):
+    """Returns a QtAwesome icon. Icons are cached so that they are only
+    rendered once, even when multiple chat widgets are created or when icons
+    are swapped, e.g. by the maximize button. If QtAwesome is not available,
+    an exception is raised.
+    """
+    # QtAwesome is optional, but it makes the UI look better. It is slow to
+    # import, so this is only done when the first icon is needed.
+    import qtawesome as qta
+    return qta.icon(name)
 
 
 class MultiLineInput(QPlainTextEdit):
@@ -92,7 +102,7 @@ class ChatWidget(QWidget):
         # Send button
         self._send_button = QPushButton()
         try:
-            self._send_button.setIcon(qta.icon('mdi6.send'))
+            self._send_button.setIcon(_icon('mdi6.send'))
         except Exception:
             self._send_button.setText('➤')
         self._send_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
@@ -104,7 +114,7 @@ class ChatWidget(QWidget):
         # Cancel button (initially hidden)
         self._cancel_button = QPushButton()
         try:
-            self._cancel_button.setIcon(qta.icon('mdi6.stop'))
+            self._cancel_button.setIcon(_icon('mdi6.stop'))
         except Exception:
             self._cancel_button.setText('⏹')
         self._cancel_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
@@ -122,7 +132,7 @@ class ChatWidget(QWidget):
         # Clear conversation button
         self._clear_button = QPushButton()
         try:
-            self._clear_button.setIcon(qta.icon('mdi6.restart'))
+            self._clear_button.setIcon(_icon('mdi6.restart'))
         except Exception:
             self._clear_button.setText('🗑️')
         self._clear_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
@@ -154,8 +164,7 @@ class ChatWidget(QWidget):
             self._chat_input.setPlaceholderText(PLACEHOLDER_TEXT)
             self._send_button.setVisible(True)
             # Enable send button only if there's enough text
-            text = self._chat_input.toPlainText().strip()
-            self._send_button.setEnabled(len(text) >= 3)
+            self._send_button.setEnabled(self._has_enough_text())
             self._cancel_button.setVisible(False)
         elif state == 'waiting':
             self._chat_input.setEnabled(False)
@@ -170,10 +179,10 @@ class ChatWidget(QWidget):
         """Update the maximize button icon based on current state."""
         try:
             if self._is_maximized:
-                self._maximize_button.setIcon(qta.icon('mdi6.arrow-collapse'))
+                self._maximize_button.setIcon(_icon('mdi6.arrow-collapse'))
                 self._maximize_button.setToolTip("Minimize input")
             else:
-                self._maximize_button.setIcon(qta.icon('mdi6.arrow-expand'))
+                self._maximize_button.setIcon(_icon('mdi6.arrow-expand'))
                 self._maximize_button.setToolTip("Maximize input")
         except Exception:
             if self._is_maximized:
@@ -206,20 +215,46 @@ class ChatWidget(QWidget):
         # Give focus back to the input
         self._chat_input.setFocus()
 
+    def _has_enough_text(self):
+        """Check whether the input, with leading and trailing whitespace
+        stripped, is at least MIN_MESSAGE_CHARS long. This is the same as
+        len(text.strip()) >= MIN_MESSAGE_CHARS, but only the leading and
+        trailing whitespace is scanned, so that we don't need to copy the
+        entire input on every keypress.
+        """
+        document = self._chat_input.document()
+        # The character count includes the final paragraph separator
+        n_chars = document.characterCount()
+        if n_chars <= MIN_MESSAGE_CHARS:
+            return False
+        start = 0
+        while start < n_chars and document.characterAt(start).isspace():
+            start += 1
+        end = n_chars - 1
+        while end > start and document.characterAt(end).isspace():
+            end -= 1
+        return end - start + 1 >= MIN_MESSAGE_CHARS
+
     def _on_text_changed(self):
-        """Enable the send button when >= 3 chars in the input."""
-        text = self._chat_input.toPlainText().strip()
-        # Only update if send button is visible (not in waiting state)
+        """Enable the send button when >= MIN_MESSAGE_CHARS chars in the input."""
+        # Only update if send button is visible (not in waiting state), and
+        # if the button state actually changes
         if self._send_button.isVisible():
-            self._send_button.setEnabled(len(text) >= 3)
+            enabled = self._has_enough_text()
+            if enabled != self._send_button.isEnabled():
+                self._send_button.setEnabled(enabled)
 
     def _on_send(self):
-        text = self._chat_input.toPlainText().strip()
         # Additional check—just in case users hack around the button
-        if len(text) < 3:
+        if not self._has_enough_text():
             return
-        # Clear the input
+        text = self._chat_input.toPlainText().strip()
+        # Clear the input. Signals are blocked so that _on_text_changed() isn't
+        # triggered, because we already know that the input is empty.
+        was_blocked = self._chat_input.blockSignals(True)
         self._chat_input.clear()
+        self._chat_input.blockSignals(was_blocked)
+        self._send_button.setEnabled(False)
         # If maximized, minimize before sending
         if self._is_maximized:
             self._minimize_input()
@@ -231,6 +266,9 @@ class ChatWidget(QWidget):
     def append_message(self, msg_type, text, scroll=True):
         self._chat_browser.append_message(msg_type, text, scroll)
 
+    def append_messages(self, messages, scroll=True):
+        self._chat_browser.append_messages(messages, scroll)
+
     def clear_messages(self):
         self._chat_browser.clear_messages()
 
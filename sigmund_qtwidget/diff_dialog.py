@@ -9,11 +9,34 @@ try:
     from pyqt_code_editor.code_editors import create_editor
     logger.info('using pyqt_code_editor')
 except ImportError:
+    # The fallback editor is only imported when a dialog is actually shown
     logger.info('using pyqode')
     create_editor = None
-    from libqtopensesame.pyqode_extras.widgets import FallbackCodeEdit
+# cdifflib is optional, but it provides a C implementation of SequenceMatcher,
+# which is much faster for large scripts. It is only used for our own diffs,
+# rather than patched into difflib, which is shared by the entire application.
+try:
+    from cdifflib import CSequenceMatcher as SequenceMatcher
+    logger.info('using cdifflib')
+except ImportError:
+    SequenceMatcher = difflib.SequenceMatcher
 
 MAX_MESSAGE_HEIGHT = 200
+# The number of unchanged lines that are shown around each change
+CONTEXT_LINES = 3
+
+
+def _format_range(start, stop):
+    """Formats a line range for a hunk header in the same way as
+    difflib.unified_diff().
+    """
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f'{beginning}'
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
 
 
 class DiffDialog(QDialog):
@@ -28,20 +51,11 @@ class DiffDialog(QDialog):
 
         self.setWindowTitle("Sigmund suggests changes")
 
-        # Use difflib.unified_diff to produce a single diff
-        diff_lines = list(difflib.unified_diff(
-            old_content.splitlines(),
-            new_content.splitlines(),
-            fromfile="Original",
-            tofile="Updated",
-            lineterm=''
-        ))
-
-        # Skip lines that are just the file headers (---, +++)
-        diff_text = "\n".join(
-            line for line in diff_lines
-            if not line.startswith('---') and not line.startswith('+++')
-        )
+        # The diff and the diff view are only created when the dialog is
+        # first shown, see _ensure_diff_view()
+        self._old_content = old_content
+        self._new_content = new_content
+        self.diff_view = None
 
         layout = QVBoxLayout()
         self.setLayout(layout)
@@ -51,34 +65,11 @@ class DiffDialog(QDialog):
         self.message_browser.append_message('ai', message)
         self.message_browser.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Minimum)
         self.message_browser.setMaximumHeight(MAX_MESSAGE_HEIGHT)
-        
-        # Create the diff view
-        if create_editor:
-            self.diff_view = create_editor(language='diff')
-            # If no changes, say so; otherwise, display the diff
-            if diff_text.strip():
-                self.diff_view.setPlainText(diff_text)
-            else:
-                self.diff_view.setPlainText("No changes suggested.")
-        else:
-            self.diff_view = FallbackCodeEdit(self)
-            self.diff_view.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-            self.diff_view.panels.remove('ReadOnlyPanel')
-            self.parent().parent().parent().extension_manager.fire(
-                'register_editor',
-                editor=self.diff_view
-            )
-            if diff_text.strip():
-                self.diff_view.setPlainText(diff_text, mime_type='text/x-diff')
-            else:
-                self.diff_view.setPlainText("No changes suggested.")
-        self.diff_view.setReadOnly(True)
 
         # Create a vertical splitter to hold the message browser and the diff
-        splitter = QSplitter(Qt.Vertical)
-        splitter.addWidget(self.message_browser)
-        splitter.addWidget(self.diff_view)
-        layout.addWidget(splitter)
+        self._splitter = QSplitter(Qt.Vertical)
+        self._splitter.addWidget(self.message_browser)
+        layout.addWidget(self._splitter)
 
         # The disclaimer label 
         disclaimer_label = QLabel(
@@ -98,12 +89,73 @@ class DiffDialog(QDialog):
 
         self.resize(800, 600)
 
+    def showEvent(self, event):
+        self._ensure_diff_view()
+        super().showEvent(event)
+
+    def _diff_text(self):
+        """Returns the unified diff between the old and new content."""
+        # If the contents are identical, there is no need to compute a diff
+        if self._old_content == self._new_content:
+            return ''
+        # The hunks are built in the same way as by difflib.unified_diff(),
+        # but without the file headers, and with our own SequenceMatcher
+        old_lines = self._old_content.splitlines()
+        new_lines = self._new_content.splitlines()
+        matcher = SequenceMatcher(None, old_lines, new_lines)
+        diff_lines = []
+        for group in matcher.get_grouped_opcodes(CONTEXT_LINES):
+            first, last = group[0], group[-1]
+            diff_lines.append(
+                f'@@ -{_format_range(first[1], last[2])} '
+                f'+{_format_range(first[3], last[4])} @@')
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    diff_lines.extend(' ' + line for line in old_lines[i1:i2])
+                    continue
+                if tag in ('replace', 'delete'):
+                    diff_lines.extend('-' + line for line in old_lines[i1:i2])
+                if tag in ('replace', 'insert'):
+                    diff_lines.extend('+' + line for line in new_lines[j1:j2])
+        return "\n".join(diff_lines)
+
+    def _ensure_diff_view(self):
+        """Creates the diff view, which involves computing the diff and
+        setting up a syntax-highlighted editor. This is deferred until the
+        dialog is shown, and only happens once.
+        """
+        if self.diff_view is not None:
+            return
+        diff_text = self._diff_text()
+        if create_editor:
+            self.diff_view = create_editor(language='diff')
+            # If no changes, say so; otherwise, display the diff
+            if diff_text.strip():
+                self.diff_view.setPlainText(diff_text)
+            else:
+                self.diff_view.setPlainText("No changes suggested.")
+        else:
+            from libqtopensesame.pyqode_extras.widgets import FallbackCodeEdit
+            self.diff_view = FallbackCodeEdit(self)
+            self.diff_view.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+            self.diff_view.panels.remove('ReadOnlyPanel')
+            self.parent().parent().parent().extension_manager.fire(
+                'register_editor',
+                editor=self.diff_view
+            )
+            if diff_text.strip():
+                self.diff_view.setPlainText(diff_text, mime_type='text/x-diff')
+            else:
+                self.diff_view.setPlainText("No changes suggested.")
+        self.diff_view.setReadOnly(True)
+        self._splitter.addWidget(self.diff_view)
+
     def done(self, r):
         """
         Called whenever the dialog finishes, whether via accept(), reject(),
         or the close button.
         """
-        if create_editor is None:
+        if create_editor is None and self.diff_view is not None:
             self.parent().parent().parent().extension_manager.fire(
                 'unregister_editor',
                 editor=self.diff_view
@@ -1,16 +1,38 @@
 import os
 import json
+import queue
 import sys
+import threading
 import traceback
-from multiprocessing import Process, Queue
-from qtpy.QtWidgets import QWidget, QVBoxLayout, QLabel
+import multiprocessing
+from qtpy.QtWidgets import QWidget, QVBoxLayout, QLabel, QStackedWidget
 from qtpy.QtGui import QPixmap
-from qtpy.QtCore import Qt, QTimer, Signal
+from qtpy.QtCore import Qt, Signal
 from . import websocket_server, chat_widget
 from .diff_dialog import DiffDialog
 import logging
 logging.basicConfig(level=logging.INFO, force=True)
 logger = logging.getLogger(__name__)
+# orjson is optional, but it is much faster than the json module for encoding
+# and decoding the messages that are exchanged with the server. orjson raises
+# exceptions that inherit from json.JSONDecodeError.
+try:
+    import orjson
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+else:
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    def json_loads(s):
+        # orjson is stricter than the json module, for example about lone
+        # surrogates and NaN, so we fall back to json for messages that orjson
+        # rejects
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return json.loads(s)
 
 WELCOME_MSG = """Sigmund is your AI research assistant
 <br><br>
@@ -22,6 +44,11 @@ NOT_LISTENING_MSG = """Failed to listen to Sigmund.
 Server failed to start."""
 FAILED_MSG = """Failed to listen to Sigmund.
 Maybe another application is already listening?"""
+PIXMAP_PATH = os.path.join(os.path.dirname(__file__), 'sigmund-full.png')
+# The reader thread wakes up at this interval (in seconds) to check whether it
+# should stop. When the server is stopped, we wait at most this long (times
+# two) for the reader thread to finish.
+READER_TIMEOUT = 0.25
 
 
 class SigmundWidget(QWidget):
@@ -32,7 +59,14 @@ class SigmundWidget(QWidget):
 
     server_state_changed = Signal(str)  # Emitted when server state changes
     token_received = Signal(str)
+    # Emitted from the queue-reader thread with the server generation and a
+    # list of messages from the server. Because the signal crosses threads, the
+    # connected slot is invoked in the GUI thread through a queued connection.
+    # The list is declared as object, so that it's passed on as is, rather
+    # than being converted to a QVariantList and back.
+    _raw_messages_received = Signal(int, object)
     chat_widget_cls = chat_widget.ChatWidget
+    _pixmap = None  # Loaded on first use, because this requires a QApplication
 
     def __init__(self, parent=None, application='Unknown'):
         super().__init__(parent)
@@ -48,6 +82,11 @@ class SigmundWidget(QWidget):
         self._transient_system_prompt = None
         self._foundation_document_topics = None
         self._retry = 1
+        # While a batch of messages is handled, or while the widget is hidden,
+        # UI refreshes are postponed until they are needed, so that multiple
+        # state changes result in a single refresh
+        self._handling_batch = False
+        self._refresh_pending = False
 
         # References to OS-specific things (injected/set by extension)
         self._workspace_manager = None
@@ -55,9 +94,21 @@ class SigmundWidget(QWidget):
         # Chat widget
         self.chat_widget = None
 
-        # Polling timer for the server queue
-        self._poll_timer = QTimer(self)
-        self._poll_timer.timeout.connect(self._poll_server_queue)
+        # Messages from the server are read by a background thread, which
+        # blocks on the queue and hands them over to the GUI thread
+        self._reader_thread = None
+        self._reader_stop = None
+        # Incremented whenever the server is stopped, so that batches that are
+        # still queued for a stopped server can be recognized and dropped
+        self._server_generation = 0
+        self._raw_messages_received.connect(self._handle_incoming_batch,
+                                            Qt.QueuedConnection)
+
+        # Each state has its own page, which is shown in a stacked widget
+        self._pages = {}
+        self._stack = QStackedWidget()
+        layout = QVBoxLayout(self)
+        layout.addWidget(self._stack)
 
         # Initial UI build
         self.refresh_ui()
@@ -73,11 +124,15 @@ class SigmundWidget(QWidget):
         if self._state in ('listening', 'connected'):
             return
         logger.debug('Starting Sigmund WebSocket server')
-        self._to_main_queue = Queue()
-        self._to_server_queue = Queue()
+        # The server is started with the spawn method, so that the (large)
+        # address space of the GUI process isn't forked. This is already the
+        # default on Windows and macOS.
+        mp_context = multiprocessing.get_context('spawn')
+        self._to_main_queue = mp_context.Queue()
+        self._to_server_queue = mp_context.Queue()
     
         try:
-            self._server_process = Process(
+            self._server_process = mp_context.Process(
                 target=websocket_server.start_server,
                 args=(self._to_main_queue, self._to_server_queue),
                 daemon=True  # Daemon mode helps if main process ends normally.
@@ -90,12 +145,19 @@ class SigmundWidget(QWidget):
         else:
             # If we're successful, we move to 'listening'
             self._update_state('listening')
-            # Start polling
-            self._poll_timer.start(100)
-            self._to_server_queue.put(json.dumps({
+            # Start reading messages from the server
+            self._reader_stop = threading.Event()
+            self._reader_thread = threading.Thread(
+                target=self._read_server_queue,
+                args=(self._to_main_queue, self._reader_stop,
+                      self._server_generation),
+                daemon=True
+            )
+            self._reader_thread.start()
+            self._to_server_queue.put({
                 "action": "connector_name",
                 "message": f'{self._application} ({os.getpid()})'
-            }))            
+            })            
             
     def stop_server(self):
         """
@@ -104,11 +166,19 @@ class SigmundWidget(QWidget):
         if self._state == 'not_listening':
             return
         logger.info('Stopping Sigmund WebSocket server')
-        self._poll_timer.stop()
         if self._server_process is not None:
             self._server_process.terminate()
             self._server_process.join()
             self._server_process = None
+        self._server_generation += 1
+        if self._reader_thread is not None:
+            # We don't write a sentinel into the queue, because the terminated
+            # process may have left it in a broken state. If the reader thread
+            # is stuck reading, it is a daemon thread and is simply abandoned.
+            self._reader_stop.set()
+            self._reader_thread.join(2 * READER_TIMEOUT)
+            self._reader_thread = None
+            self._reader_stop = None
         self._to_main_queue = None
         self._to_server_queue = None
         self._update_state('not_listening')
@@ -145,15 +215,15 @@ class SigmundWidget(QWidget):
             "workspace_content": workspace_content,
             "workspace_language": workspace_language,
             "attachments": self._attachments,
-            "transient_settings": (json.dumps(self._transient_settings)
+            "transient_settings": (json_dumps(self._transient_settings)
                                    if self._transient_settings else None),
             "transient_system_prompt": self._transient_system_prompt,
             "foundation_document_topics": (
-                json.dumps(self._foundation_document_topics)
+                json_dumps(self._foundation_document_topics)
                 if self._foundation_document_topics else None
             )
         }
-        self._to_server_queue.put(json.dumps(user_json))
+        self._to_server_queue.put(user_json)
         
     def send_user_triggered_message(self, *args, **kwargs):
         """Can be reimplemented to handle certain logic that only applies to
@@ -163,84 +233,157 @@ class SigmundWidget(QWidget):
         self.send_user_message(*args, **kwargs)
         
     def clear_conversation(self):
-        self._to_server_queue.put(json.dumps({
+        self._to_server_queue.put({
             "action": "clear_conversation"
-        }))
+        })
         
     def cancel_streaming(self):
-        self._to_server_queue.put(json.dumps({
+        self._to_server_queue.put({
             "action": "cancel_streaming"
-        }))
+        })
 
     def refresh_ui(self):
-        layout = self.layout()
-        if layout is not None:
-            # Remove widgets from the old layout, but do not destroy self.chat_widget.
-            while layout.count():
-                item = layout.takeAt(0)
-                widget = item.widget()
-                if widget is not None:
-                    widget.deleteLater()
-        else:
-            # Create and configure the new layout
-            layout = QVBoxLayout()
-            layout.setSpacing(10)
-    
-        if self._state == 'connected':
+        """Show the page for the current state. Pages are created the first
+        time that a state is entered, and are reused after that, so that
+        switching between states doesn't require rebuilding widgets.
+        """
+        page = self._pages.get(self._state)
+        if page is None:
+            page = self._create_page(self._state)
+            self._pages[self._state] = page
+            self._stack.addWidget(page)
+        self._stack.setCurrentWidget(page)
+
+    def _create_page(self, state):
+        """Create the widget that is shown for a given state."""
+        if state == 'connected':
             self.chat_widget = self.chat_widget_cls(self)
             self.chat_widget.user_message_sent.connect(
                 self.send_user_triggered_message)
             self.chat_widget.clear_conversation_requested.connect(
                 self.clear_conversation)
             self.chat_widget.cancel_requested.connect(self.cancel_streaming)
-            layout.addWidget(self.chat_widget)
+            return self.chat_widget
+        page = QWidget()
+        layout = QVBoxLayout(page)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(10)
+        pix_label = QLabel()
+        pix_label.setAlignment(Qt.AlignCenter)
+        # The pixmap is only loaded once and then shared between widgets
+        if SigmundWidget._pixmap is None:
+            SigmundWidget._pixmap = QPixmap(PIXMAP_PATH)
+        pix_label.setPixmap(SigmundWidget._pixmap)
+        layout.addWidget(pix_label)
+
+        state_label = QLabel()
+        state_label.setTextFormat(Qt.RichText)
+        state_label.setTextInteractionFlags(Qt.TextBrowserInteraction)
+        state_label.setWordWrap(True)
+        state_label.setOpenExternalLinks(True)
+        state_label.setAlignment(Qt.AlignCenter)
+
+        if state == 'failed':
+            state_label.setText(FAILED_MSG)
+        elif state == 'not_listening':
+            state_label.setText(NOT_LISTENING_MSG)
         else:
-            pix_label = QLabel()
-            pix_label.setAlignment(Qt.AlignCenter)
-            pixmap = QPixmap(os.path.join(os.path.dirname(__file__), 'sigmund-full.png'))
-            pix_label.setPixmap(pixmap)
-            layout.addWidget(pix_label)
-    
-            state_label = QLabel()
-            state_label.setTextFormat(Qt.RichText)
-            state_label.setTextInteractionFlags(Qt.TextBrowserInteraction)
-            state_label.setWordWrap(True)
-            state_label.setOpenExternalLinks(True)
-            state_label.setAlignment(Qt.AlignCenter)
-    
-            if self._state == 'failed':
-                state_label.setText(FAILED_MSG)
-            elif self._state == 'not_listening':
-                state_label.setText(NOT_LISTENING_MSG)
-            else:
-                state_label.setText(WELCOME_MSG.format(
-                    application=self._application))
-            layout.addWidget(state_label)
-            layout.addStretch()
-    
-        # Assign the new layout
-        self.setLayout(layout)
+            state_label.setText(WELCOME_MSG.format(
+                application=self._application))
+        layout.addWidget(state_label)
+        layout.addStretch()
+        return page
 
     # ----------
     # Internals
     # ----------
 
-    def _poll_server_queue(self):
+    def _read_server_queue(self, to_main_queue, stop, generation):
         """
-        Called periodically by a QTimer to see if there are new messages
-        from the WebSocket server. If so, parse them.
+        Runs in a background thread and blocks until there are new messages
+        from the WebSocket server. Any other messages that are already waiting
+        are collected as well, and the batch is passed on to the GUI thread
+        through a signal. This avoids having to poll the queue actively. Stops
+        when the stop event is set, or when the queue breaks.
+
+        JSON messages are already parsed here, so that the GUI thread doesn't
+        need to parse large messages, such as AI messages with workspace
+        content.
         """
-        if not self._to_main_queue:
-            return
-        while not self._to_main_queue.empty():
-            msg = self._to_main_queue.get()
-            if not isinstance(msg, str):
+        while not stop.is_set():
+            try:
+                batch = [to_main_queue.get(timeout=READER_TIMEOUT)]
+            except queue.Empty:
                 continue
-            self._handle_incoming_raw(msg)
+            except (EOFError, OSError, ValueError) as e:
+                logger.error(f'failed to read from server queue: {e}')
+                break
+            while True:
+                try:
+                    batch.append(to_main_queue.get_nowait())
+                except queue.Empty:
+                    break
+                except (EOFError, OSError, ValueError):
+                    break
+            batch = [self._parse_raw(msg) for msg in batch
+                     if isinstance(msg, str)]
+            if batch and not stop.is_set():
+                self._raw_messages_received.emit(generation, batch)
+
+    @staticmethod
+    def _parse_raw(raw_msg):
+        """Returns the parsed message if raw_msg is a JSON object, or
+        raw_msg itself otherwise. Invalid JSON is also returned as is, and
+        reported when it is handled.
+        """
+        if not raw_msg.startswith('{'):
+            return raw_msg
+        try:
+            return json_loads(raw_msg)
+        except json.JSONDecodeError:
+            return raw_msg
+
+    def _handle_incoming_batch(self, generation, raw_msgs):
+        """Handle a batch of raw messages. The UI is refreshed at most once,
+        after the batch has been handled, unless a message requires the UI to
+        be up to date. Batches that were read before the server was stopped
+        are ignored.
+        """
+        if generation != self._server_generation:
+            return
+        self._handling_batch = True
+        try:
+            for raw_msg in raw_msgs:
+                self._handle_incoming_raw(raw_msg)
+        finally:
+            self._handling_batch = False
+            # While the widget is hidden, the refresh is postponed until it is
+            # shown again, see showEvent()
+            if self.isVisible():
+                self._flush_pending_refresh()
+
+    def showEvent(self, event):
+        self._flush_pending_refresh()
+        super().showEvent(event)
+
+    def _flush_pending_refresh(self):
+        """Perform a UI refresh that was postponed while handling a batch or
+        while the widget was hidden.
+        """
+        if self._refresh_pending:
+            self._refresh_pending = False
+            self.refresh_ui()
 
     def _handle_incoming_raw(self, raw_msg):
-        """ Parse raw messages from the server into actions/data. """
-        if raw_msg.startswith('[DEBUG]'):
+        """ Parse raw messages from the server into actions/data. Messages
+        that have already been parsed by the reader thread are dicts.
+        """
+        # JSON messages are by far the most common, so we check for them first
+        if isinstance(raw_msg, dict):
+            self._handle_incoming_data(raw_msg)
+        elif raw_msg.startswith('{'):
+            self._handle_incoming_json(raw_msg)
+        elif raw_msg.startswith('[DEBUG]'):
             logger.info(raw_msg)
             return
         elif raw_msg.startswith('FAILED_TO_START'):
@@ -248,8 +391,10 @@ class SigmundWidget(QWidget):
             return
         elif raw_msg == "CLIENT_CONNECTED":
             self._update_state('connected')
+            # The chat widget is reused between connections, so we reset it
             if self.chat_widget:
                 self.chat_widget.clear_messages()
+                self.chat_widget.setEnabled(True)
             # Optionally request an auth token
             self._request_token()
         elif raw_msg == "CLIENT_DISCONNECTED":
@@ -257,87 +402,108 @@ class SigmundWidget(QWidget):
             if self._server_process is not None:
                 self._update_state('listening')
         else:
-            # Likely JSON
-            try:
-                data = json.loads(raw_msg)
-            except json.JSONDecodeError:
-                logger.error(f'invalid incoming JSON: {raw_msg}')
-                return
-            # Directly handle messages here
-            self._on_message_received(data)
+            self._handle_incoming_json(raw_msg)
+
+    def _handle_incoming_json(self, raw_msg):
+        """Parse a JSON message and pass it on to _handle_incoming_data()."""
+        # Likely JSON
+        try:
+            data = json_loads(raw_msg)
+        except json.JSONDecodeError:
+            logger.error(f'invalid incoming JSON: {raw_msg}')
+            return
+        self._handle_incoming_data(data)
+
+    def _handle_incoming_data(self, data):
+        """Pass a parsed message on to _on_message_received()."""
+        # Messages are handled by the chat widget, so the UI needs to be
+        # up to date
+        self._flush_pending_refresh()
+        # Directly handle messages here
+        self._on_message_received(data)
 
     def _on_message_received(self, data) -> bool:
         """Handle parsed messages from the server. The return value indicates
         whether or not an automatic reply was sent, for example a continue 
         message or tool results.
+
+        Each action is handled by a method called `_on_action_[action]()`,
+        which receives the message data as its only argument.
         """
         action = data.get("action", None)
         if not self.chat_widget:
             return False
+        handler = getattr(self, f'_on_action_{action}', None)
+        if handler is None:
+            logger.error(f'invalid or unhandled incoming message: {data}')
+            return False
+        return bool(handler(data))
 
-        if action == 'token':
-            token = data.get('message', '')
-            if token:
-                self.token_received.emit(token)
-        elif action == 'clear_messages':
-            self.chat_widget.clear_messages()
+    def _on_action_token(self, data):
+        token = data.get('message', '')
+        if token:
+            self.token_received.emit(token)
 
-        elif action == 'cancel_message':
-            self.chat_widget.setEnabled(True)
+    def _on_action_clear_messages(self, data):
+        self.chat_widget.clear_messages()
 
-        elif action == 'user_message':
-            message_text = data.get("message", "")
-            self.chat_widget.append_message("user", message_text)
+    def _on_action_cancel_message(self, data):
+        self.chat_widget.setEnabled(True)
 
-        elif action == "ai_incoming":            
-            if self.chat_widget:
-                self.chat_widget.setState('waiting')
-            
-        elif action == "ai_message":
-            # Show the AI message
-            message_text = data.get("message", "")
-            self.chat_widget.append_message("ai", message_text)
-            self.chat_widget.setEnabled(True)
-            # Attempt to apply workspace changes, if any
-            workspace_content = data.get("workspace_content", "")
-            workspace_language = data.get("workspace_language", "markdown")            
-            if self._workspace_manager:
-                workspace_content = self._workspace_manager.prepare(
-                    workspace_content)
-                if not self._workspace_manager.has_changed(
-                    workspace_content, workspace_language
-                ):
-                    workspace_content = None
-            on_connect = data.get("on_connect", False)
-            if not on_connect and workspace_content:
-                # If the workspace content is a run command, we don't process it
-                # further.
-                if self.run_command(message_text, workspace_content):
-                    return True
-                if self._workspace_manager and self.confirm_change(
-                        message_text, workspace_content):
-                    try:
-                        self._workspace_manager.set(workspace_content,
-                                                    workspace_language)
-                    except Exception:
-                        err_msg = f'''The following error occurred when I tried to use the workspace content:
-                        
+    def _on_action_user_message(self, data):
+        message_text = data.get("message", "")
+        self.chat_widget.append_message("user", message_text)
+
+    def _on_action_ai_incoming(self, data):
+        self.chat_widget.setState('waiting')
+
+    def _on_action_ai_message(self, data):
+        # Show the AI message
+        message_text = data.get("message", "")
+        self.chat_widget.append_message("ai", message_text)
+        self.chat_widget.setEnabled(True)
+        # Attempt to apply workspace changes, if any. Messages that are
+        # sent on connect never change the workspace, so for those (and for
+        # messages without workspace content) we don't need to prepare and
+        # compare the workspace content at all.
+        workspace_content = data.get("workspace_content", "")
+        on_connect = data.get("on_connect", False)
+        if on_connect or not workspace_content:
+            return False
+        workspace_language = data.get("workspace_language", "markdown")            
+        if self._workspace_manager:
+            workspace_content = self._workspace_manager.prepare(
+                workspace_content)
+            if not self._workspace_manager.has_changed(
+                workspace_content, workspace_language
+            ):
+                return False
+        # If the workspace content is a run command, we don't process it
+        # further.
+        if self.run_command(message_text, workspace_content):
+            return True
+        if self._workspace_manager and self.confirm_change(
+                message_text, workspace_content):
+            try:
+                self._workspace_manager.set(workspace_content,
+                                            workspace_language)
+            except Exception:
+                err_msg = f'''The following error occurred when I tried to use the workspace content:
+                
 ```
 {traceback.format_exc()}
 ```
 '''
-                        self.chat_widget.append_message('user', err_msg)
-                        if not self._retry:
-                            self.chat_widget.append_message('ai',
-                                'Maximum number of attempts exceeded.')
-                        else:
-                            self.send_user_message(err_msg, workspace_content,
-                                                   workspace_language,
-                                                   retry=self._retry - 1)
-                            return True
-        else:
-            logger.error(f'invalid or unhandled incoming message: {data}')
-        return False    
+                self.chat_widget.append_message('user', err_msg)
+                if not self._retry:
+                    self.chat_widget.append_message('ai',
+                        'Maximum number of attempts exceeded.')
+                else:
+                    self.send_user_message(err_msg, workspace_content,
+                                           workspace_language,
+                                           retry=self._retry - 1)
+                    return True
+        return False
             
     def confirm_change(self, message_text, workspace_content,
                        original_workspace_content=None):
@@ -370,7 +536,7 @@ class SigmundWidget(QWidget):
         if not isinstance(workspace_content, str):
             return False
         try:
-            data = json.loads(workspace_content)
+            data = json_loads(workspace_content)
         except json.JSONDecodeError:
             return False
         if isinstance(data, dict):
@@ -411,12 +577,18 @@ class SigmundWidget(QWidget):
         
     def _request_token(self):
         if self._to_server_queue:
-            self._to_server_queue.put(json.dumps({"action": "get_token"}))
+            self._to_server_queue.put({"action": "get_token"})
 
     def _update_state(self, new_state):
         """Set the state and emit a signal so that the extension can pick it up."""
         if new_state == self._state:
             return
         self._state = new_state
-        self.refresh_ui()
+        # The refresh is postponed while handling a batch of messages, and
+        # while the widget is hidden, in which case it happens when the widget
+        # is shown again
+        if self._handling_batch or not self.isVisible():
+            self._refresh_pending = True
+        else:
+            self.refresh_ui()
         self.server_state_changed.emit(new_state)
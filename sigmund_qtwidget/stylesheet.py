@@ -1,3 +1,4 @@
+import re
 from pathlib import Path
 from qtpy.QtGui import QGuiApplication
 from qtpy.QtCore import Qt
@@ -12,4 +13,8 @@ except Exception as e:
     logger.error(f'failed to detect dark mode: {e}')
 logger.info(f'using {mode} mode')
 css = Path(__file__).parent / f"stylesheet-{mode}.css"
-DEFAULT_STYLESHEET = css.read_text()
+# Qt parses the default stylesheet whenever HTML is added to a chat, so
+# comments and redundant whitespace are removed once here
+DEFAULT_STYLESHEET = re.sub(
+    r'\s+', ' ', re.sub(r'/\*.*?\*/', '', css.read_text(), flags=re.DOTALL)
+).strip()
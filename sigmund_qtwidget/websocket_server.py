@@ -1,16 +1,30 @@
 import asyncio
+import json
 import websockets
 import sys
-import queue
+import threading
+# orjson is optional, but it is much faster than the json module for encoding
+# large messages, such as messages that contain the full workspace content.
+try:
+    import orjson
+except ImportError:
+    json_dumps = json.dumps
+else:
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
 
 client_connected = False
+# Every item that is put on the queue is pickled and sent through a pipe to
+# the main process. To keep this traffic low, debug messages for individual
+# chat messages are only sent when this is enabled.
+DEBUG_MESSAGES = False
 
 
-async def queue_manager(websocket, to_main_queue, to_server_queue):
+async def queue_manager(websocket, to_main_queue, outgoing_queue):
     """
     Concurrently read from the client and write to the client.
     Reading side: Puts messages into to_main_queue.
-    Writing side: Polls messages from to_server_queue (non-blocking),
+    Writing side: Waits for messages on outgoing_queue (an asyncio.Queue),
                   then sends them to the client.
     """
 
@@ -18,7 +32,8 @@ async def queue_manager(websocket, to_main_queue, to_server_queue):
         to_main_queue.put("[DEBUG] Starting read_task")
         try:
             async for message in websocket:
-                to_main_queue.put(f"[DEBUG] Message received from client")
+                if DEBUG_MESSAGES:
+                    to_main_queue.put(f"[DEBUG] Message received from client")
                 to_main_queue.put(message)
         except websockets.exceptions.ConnectionClosed:
             to_main_queue.put("[DEBUG] Client connection closed (read_task)")
@@ -29,12 +44,25 @@ async def queue_manager(websocket, to_main_queue, to_server_queue):
         to_main_queue.put("[DEBUG] Starting write_task")
         try:
             while True:
-                try:
-                    msg_to_send = to_server_queue.get_nowait()
-                except queue.Empty:
-                    await asyncio.sleep(0.1)
-                    continue
-                to_main_queue.put(f"[DEBUG] Sending message to client")
+                msg_to_send = await outgoing_queue.get()
+                # Messages are put on the queue as dicts, so that they are
+                # encoded here rather than in the GUI thread of the main process
+                if not isinstance(msg_to_send, str):
+                    try:
+                        msg_to_send = json_dumps(msg_to_send)
+                    except (TypeError, ValueError):
+                        # orjson is stricter than the json module, for
+                        # example about very large ints, so we fall back to
+                        # json before giving up on this message. A message
+                        # that cannot be encoded should not end the task.
+                        try:
+                            msg_to_send = json.dumps(msg_to_send)
+                        except (TypeError, ValueError) as e:
+                            to_main_queue.put(
+                                f"[DEBUG] Failed to encode message: {e}")
+                            continue
+                if DEBUG_MESSAGES:
+                    to_main_queue.put(f"[DEBUG] Sending message to client")
                 await websocket.send(msg_to_send)
         except websockets.exceptions.ConnectionClosed:
             to_main_queue.put("[DEBUG] Client connection closed (write_task)")
@@ -52,7 +80,7 @@ async def queue_manager(websocket, to_main_queue, to_server_queue):
         task.cancel()
 
 
-async def server_handler(websocket, to_main_queue, to_server_queue):
+async def server_handler(websocket, to_main_queue, outgoing_queue):
     """
     Handles a new client connection. We only allow one client at a time. 
     If a client is already connected, refuse this new connection immediately.
@@ -69,7 +97,7 @@ async def server_handler(websocket, to_main_queue, to_server_queue):
         to_main_queue.put("CLIENT_CONNECTED")
 
     try:
-        await queue_manager(websocket, to_main_queue, to_server_queue)
+        await queue_manager(websocket, to_main_queue, outgoing_queue)
     except Exception as e:
         to_main_queue.put(f"[DEBUG] An error occurred: {e}")
     finally:
@@ -78,10 +106,33 @@ async def server_handler(websocket, to_main_queue, to_server_queue):
         to_main_queue.put("CLIENT_DISCONNECTED")
 
 
+def forward_queue(to_server_queue, loop, outgoing_queue):
+    """
+    Runs in a background thread, blocks until there are new messages from the
+    main process, and forwards them to the asyncio queue. This way, the event
+    loop doesn't need to poll the multiprocessing queue.
+    """
+    while True:
+        msg = to_server_queue.get()
+        try:
+            loop.call_soon_threadsafe(outgoing_queue.put_nowait, msg)
+        except RuntimeError:
+            # The event loop has been closed
+            break
+
+
 async def serve_ws(to_main_queue, to_server_queue):
+    # Messages from the main process are forwarded by a single thread to an
+    # asyncio queue, from which they are sent to whichever client is connected
+    outgoing_queue = asyncio.Queue()
+    threading.Thread(
+        target=forward_queue,
+        args=(to_server_queue, asyncio.get_running_loop(), outgoing_queue),
+        daemon=True
+    ).start()
     # Create the websocket server and keep it running forever
     async with websockets.serve(
-        lambda ws: server_handler(ws, to_main_queue, to_server_queue),
+        lambda ws: server_handler(ws, to_main_queue, outgoing_queue),
         "localhost",
         8080,
         max_size=None